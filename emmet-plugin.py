@@ -43,6 +43,27 @@ settings = None
 # Default ST settings
 user_settings = None
 
+# Completions lists for known HTML tags and attributes. Source data
+# is static so generated lists are never invalidated
+_ELEM_ATTR_CACHE = {}
+_ATTR_VAL_CACHE = {}
+
+# Snapshot of Emmet settings queried on every keystroke,
+# refreshed by `cache_settings()` when settings are changed
+_DISABLE_COMPLETIONS = False
+_COMPLETIONS_BLACKLIST = frozenset()
+_BANNED_SCOPES = ''
+_CLEAR_FIELDS_ON_ENTER = False
+_USE_OLD_TAB_HANDLER = False
+_CSS_COMPLETIONS_SCOPE = ''
+_SHOW_CSS_COMPLETIONS = False
+
+# Last user data payload loaded into JS context
+_last_user_data = None
+
+# Scope names at the beginning of opened views, keyed by view id
+_base_scopes = {}
+
 def is_st3():
 	return sublime.version()[0] == '3'
 
@@ -67,6 +88,8 @@ def init():
 	globals()['user_settings'] = sublime.load_settings('Preferences.sublime-settings')
 	globals()['settings'] = sublime.load_settings('Emmet.sublime-settings')
 	settings.add_on_change('extensions_path', update_settings)
+	settings.add_on_change('emmet_cached_settings', cache_settings)
+	cache_settings()
 
 	# setup environment for PyV8 loading
 	pyv8_paths = [
@@ -198,8 +221,7 @@ def replace_substring(start, end, value, no_indent=False):
 	view.sel().clear()
 	view.sel().add(sublime.Region(start, end or start)) 
 
-	if not is_python3:
-		value = value.decode('utf-8')
+	value = to_unicode(value)
 
 	# XXX a bit naive indentation control. It handles most common
 	# `no_indent` usages like replacing CSS rule content, but may not
@@ -211,29 +233,39 @@ def replace_substring(start, end, value, no_indent=False):
 
 	view.run_command('insert_snippet', {'contents': value})
 
+def to_unicode(value):
+	"Returns unicode string, decoding UTF-8 bytes on Python 2 only when needed"
+	if is_python3 or isinstance(value, unicode):
+		return value
+
+	return value.decode('utf-8')
+
 def unindent_text(text, pad):
 	"""
 	Removes padding at the beginning of each text's line
 	@type text: str
 	@type pad: str
 	"""
-	lines = text.splitlines()
-	
-	for i,line in enumerate(lines):
-		if line.startswith(pad):
-			lines[i] = line[len(pad):]
-	
-	return '\n'.join(lines)
+	# like splitlines(), do not produce empty line for trailing newline
+	if text.endswith('\n'):
+		text = text[:-1]
+
+	if not pad:
+		return text
+
+	n = len(pad)
+	return '\n'.join(line[n:] if line.startswith(pad) else line
+		for line in text.split('\n'))
 
 def get_line_padding(line):
 	"""
 	Returns padding of current editor's line
 	@return str
 	"""
-	m = re.match(r'^(\s+)', line)
-	return m and m.group(0) or ''
+	return line[:len(line) - len(line.lstrip())]
 
-def update_settings():
+def update_settings(force=False):
+	prev_ext_path = ctx.get_ext_path()
 	ctx.set_ext_path(get_extensions_path())
 
 	keys = ['snippets', 'preferences', 'syntaxProfiles', 'profiles']
@@ -243,10 +275,29 @@ def update_settings():
 		if data:
 			payload[k] = data
 
+	user_data = json.dumps(payload, sort_keys=True)
+
+	# resetting JS context is expensive: do it only if
+	# user data or extensions path were actually changed
+	if (not force and user_data == _last_user_data and 
+		prev_ext_path == ctx.get_ext_path()):
+		return
+
+	globals()['_last_user_data'] = user_data
 	ctx.reset()
-	ctx.load_user_data(json.dumps(payload))
+	ctx.load_user_data(user_data)
 	ctx.js()
 
+def cache_settings():
+	"Takes snapshot of settings used by keystroke handlers"
+	globals()['_DISABLE_COMPLETIONS'] = settings.get('disable_completions', False)
+	globals()['_COMPLETIONS_BLACKLIST'] = frozenset(settings.get('completions_blacklist', None) or [])
+	globals()['_BANNED_SCOPES'] = settings.get('disable_tab_abbreviations_for_scopes', '')
+	globals()['_CLEAR_FIELDS_ON_ENTER'] = settings.get('clear_fields_on_enter_key', False)
+	globals()['_USE_OLD_TAB_HANDLER'] = settings.get('use_old_tab_handler', False)
+	globals()['_CSS_COMPLETIONS_SCOPE'] = settings.get('css_completions_scope', '')
+	globals()['_SHOW_CSS_COMPLETIONS'] = settings.get('show_css_completions', False)
+
 def get_scope(view, pt=-1):
 	if pt == -1:
 		# use current caret position
@@ -257,6 +308,39 @@ def get_scope(view, pt=-1):
 
 	return view.syntax_name(pt)
 
+def cache_base_scope(view):
+	"""
+	Caches scope name at the beginning of given view. Cached value
+	is dropped as soon as view syntax is changed
+	@return str
+	"""
+	view_id = view.id()
+	view_settings = view.settings()
+	syntax = view_settings.get('syntax')
+
+	def on_change():
+		if view_settings.get('syntax') != syntax:
+			_base_scopes.pop(view_id, None)
+
+	view_settings.clear_on_change('emmet_base_scope')
+	view_settings.add_on_change('emmet_base_scope', on_change)
+
+	base_scope = _base_scopes[view_id] = get_scope(view, 0)
+	return base_scope
+
+def get_base_scope(view):
+	"Returns cached scope name at the beginning of given view"
+	base_scope = _base_scopes.get(view.id())
+	if base_scope is None:
+		base_scope = cache_base_scope(view)
+
+	return base_scope
+
+def is_markup_view(view):
+	"Quick check if given view may contain HTML or XML markup"
+	base_scope = get_base_scope(view)
+	return 'text.html' in base_scope or 'text.xml' in base_scope
+
 def should_perform_action(name, view=None):
 	if not view:
 		view = active_view()
@@ -287,7 +371,8 @@ def should_handle_tab_key(syntax=None):
 		return True
 
 	with ctx.js() as c:
-		abbr = c.locals.pyExtractAbbreviation()
+		js = c.locals
+		abbr = js.pyExtractAbbreviation()
 
 		disabled_snippets = settings.get('disabled_single_snippets', '').split()
 		if disabled_snippets and abbr in disabled_snippets:
@@ -303,13 +388,13 @@ def should_handle_tab_key(syntax=None):
 
 		# detect inline CSS
 		if syntax is None:
-			syntax = c.locals.pyGetSyntax();
+			syntax = js.pyGetSyntax();
 
 		if syntax == 'css':
 			return True
 
 		known_tags = settings.get('known_html_tags', '').split()
-		if abbr in known_tags or c.locals.pyHasSnippet(abbr):
+		if abbr in known_tags or js.pyHasSnippet(abbr):
 			return True
 
 	return False
@@ -385,8 +470,7 @@ def run_action(action, view=None):
 
 	# output all saved regions as selection
 	view.sel().clear()
-	for sel in view.get_regions(region_key):
-		view.sel().add(sel)
+	view.sel().add_all(view.get_regions(region_key))
 
 	view.erase_regions(region_key)
 
@@ -395,41 +479,71 @@ def run_action(action, view=None):
 	return result
 
 class TabAndCompletionsHandler():
-	def correct_syntax(self, view, syntax='html'):
-		return syntax == 'html' and view.match_selector( view.sel()[0].b, cmpl.EMMET_SCOPE )
-
-	def completion_handler(self, view):
-		"Returns completions handler fo current caret position"
-		black_list = settings.get('completions_blacklist', [])
-
+	def __init__(self):
 		# A mapping of scopes, sub scopes and handlers, first matching of which
 		# is used.
-		COMPLETIONS = (
-			(cmpl.HTML_INSIDE_TAG, self.html_elements_attributes),
-			(cmpl.HTML_INSIDE_TAG_ATTRIBUTE, self.html_attributes_values)
+		self._completions = (
+			(cmpl.HTML_INSIDE_TAG, self.html_elements_attributes, 'html_elements_attributes'),
+			(cmpl.HTML_INSIDE_TAG_ATTRIBUTE, self.html_attributes_values, 'html_attributes_values')
 		)
 
-		pos = view.sel()[0].b
+	def correct_syntax(self, view, syntax='html', pos=None):
+		if syntax != 'html' or not is_markup_view(view):
+			return False
+
+		if pos is None:
+			pos = view.sel()[0].b
+		return view.match_selector(pos, cmpl.EMMET_SCOPE)
+
+	def completion_handler(self, view, pos=None):
+		"Returns completions handler fo current caret position"
+		black_list = _COMPLETIONS_BLACKLIST
+		if not black_list:
+			return None
+
+		if pos is None:
+			pos = view.sel()[0].b
+
+		# scopes are fetched once, on first use, and matched against
+		# selectors as strings
+		scope_a = scope_b = None
 
 		# Try to find some more specific contextual abbreviation
-		for sub_selector, handler in COMPLETIONS:
-			h_name = handler.__name__
-			if not black_list or h_name in black_list: continue
-			if (view.match_selector(pos,  sub_selector) or
-				 view.match_selector(pos - 1,  sub_selector)):
+		for sub_selector, handler, h_name in self._completions:
+			if h_name in black_list: continue
+			if scope_a is None:
+				scope_a = get_scope(view, pos)
+			if sublime.score_selector(scope_a, sub_selector):
+				return handler
+
+			if scope_b is None:
+				scope_b = get_scope(view, pos - 1) if pos > 0 else scope_a
+			if sublime.score_selector(scope_b, sub_selector):
 				return handler
 
 		return None
 
 	def html_elements_attributes(self, view, prefix, pos):
 		tag         = cmpl.find_tag_name(view, pos)
-		values      = HTML_ELEMENTS_ATTRIBUTES.get(tag, [])
-		return [(v,   '%s\t@%s' % (v,v), '%s="$1"' % v) for v in values]
+		cached      = _ELEM_ATTR_CACHE.get(tag)
+		if cached is None:
+			if tag not in HTML_ELEMENTS_ATTRIBUTES:
+				return []
+			values  = HTML_ELEMENTS_ATTRIBUTES[tag]
+			cached  = [(v,   '%s\t@%s' % (v,v), '%s="$1"' % v) for v in values]
+			_ELEM_ATTR_CACHE[tag] = cached
+		return cached
 
 	def html_attributes_values(self, view, prefix, pos):
 		attr        = cmpl.find_attribute_name(view, pos)
-		values      = HTML_ATTRIBUTES_VALUES.get(attr, [])
-		return [(v, '%s\t@=%s' % (v,v), v) for v in values]
+		cached      = _ATTR_VAL_CACHE.get(attr)
+		if cached is None:
+			if attr not in HTML_ATTRIBUTES_VALUES:
+				return []
+			values  = HTML_ATTRIBUTES_VALUES[attr]
+			cached  = [(v, '%s\t@=%s' % (v,v), v) for v in values]
+			_ATTR_VAL_CACHE[attr] = cached
+		return cached
 
 	def expand_by_tab(self, view):
 		if not check_context():
@@ -441,18 +555,20 @@ class TabAndCompletionsHandler():
 		if not should_handle_tab_key(syntax):
 			return False
 
+		sel = view.sel()[0]
+
 		# we need to filter out attribute completions if 
 		# 'disable_completions' option is not active
-		if (not settings.get('disable_completions', False) and 
-			self.correct_syntax(view, syntax) and 
-			self.completion_handler(view)):
+		if (not _DISABLE_COMPLETIONS and 
+			self.correct_syntax(view, syntax, sel.b) and 
+			self.completion_handler(view, sel.b)):
 				return None
 
-		caret_pos = view.sel()[0].begin()
-		cur_scope = get_scope(view)
+		caret_pos = sel.begin()
+		cur_scope = get_scope(view, caret_pos)
 
 		# let's see if Tab key expander should be disabled for current scope
-		banned_scopes = settings.get('disable_tab_abbreviations_for_scopes', '')
+		banned_scopes = _BANNED_SCOPES
 		if banned_scopes and view.score_selector(caret_pos, banned_scopes):
 			return None
 
@@ -468,7 +584,7 @@ class TabAndCompletionsHandler():
 
 class ExpandAbbreviationByTab(sublime_plugin.TextCommand):
 	def run(self, edit, **kw):
-		if settings.get('use_old_tab_handler', False):
+		if _USE_OLD_TAB_HANDLER:
 			return
 			
 		view = active_view()
@@ -482,21 +598,23 @@ class ExpandAbbreviationByTab(sublime_plugin.TextCommand):
 
 
 class TabExpandHandler(sublime_plugin.EventListener):
+	def __init__(self):
+		self.handler = TabAndCompletionsHandler()
+
 	def on_query_context(self, view, key, op, operand, match_all):
 		if key != 'is_abbreviation':
 			return None
 
-		if settings.get('use_old_tab_handler', False):
-			h = TabAndCompletionsHandler()
-			return h.expand_by_tab(view)
+		if _USE_OLD_TAB_HANDLER:
+			return self.handler.expand_by_tab(view)
 
 		return check_context()
 
 	def on_query_completions(self, view, prefix, locations):
-		h = TabAndCompletionsHandler()
-		if view.match_selector(locations[0], settings.get('css_completions_scope', '')) and check_context():
+		h = self.handler
+		if view.match_selector(locations[0], _CSS_COMPLETIONS_SCOPE) and check_context():
 			l = []
-			if settings.get('show_css_completions', False):
+			if _SHOW_CSS_COMPLETIONS:
 				with ctx.js() as c:
 					completions = c.locals.pyGetCSSCompletions()
 					if completions:
@@ -508,12 +626,15 @@ class TabExpandHandler(sublime_plugin.EventListener):
 
 			return (l, sublime.INHIBIT_WORD_COMPLETIONS | sublime.INHIBIT_EXPLICIT_COMPLETIONS)
 
-		if not h.correct_syntax(view) or settings.get('disable_completions', False):
+		if _DISABLE_COMPLETIONS:
+			return []
+
+		pos = view.sel()[0].b
+		if not h.correct_syntax(view, pos=pos):
 			return []
 
-		handler = h.completion_handler(view)
+		handler = h.completion_handler(view, pos)
 		if handler:
-			pos = view.sel()[0].b
 			completions = handler(view, prefix, pos)
 			return completions
 
@@ -539,8 +660,7 @@ class CommandsAsYouTypeBase(sublime_plugin.TextCommand):
 				if view.substr(trailing).isspace():
 					view.erase(edit, trailing)
 
-		if not is_python3:
-			processed_input = processed_input.decode('utf-8')
+		processed_input = to_unicode(processed_input)
 		view.run_command('insert_snippet', { 'contents': processed_input })
 
 	def on_panel_change(self, abbr):
@@ -621,11 +741,12 @@ class WrapAsYouType(CommandsAsYouTypeBase):
 		self._prev_output = ''
 
 		with ctx.js() as c: 
-			r = c.locals.pyResetCache()
+			js = c.locals
+			r = js.pyResetCache()
 			if len(view.sel()) == 1:
 				# capture wrapping context (parent HTML element) 
 				# if there is only one selection
-				r = c.locals.pyCaptureWrappingRange()
+				r = js.pyCaptureWrappingRange()
 				if r:
 					view.sel().clear()
 					view.sel().add(sublime.Region(r[0], r[1]))
@@ -741,12 +862,22 @@ class UpdateAsYouType(WrapAsYouType):
 			region = sublime.Region(r['start'], r['end'])
 			view.replace(edit, region, content)
 
+class BaseScopeTracker(sublime_plugin.EventListener):
+	def update_base_scope(self, view):
+		cache_base_scope(view)
+
+	on_new = on_load = on_activated = on_post_save = update_base_scope
+
+	def on_close(self, view):
+		view.settings().clear_on_change('emmet_base_scope')
+		_base_scopes.pop(view.id(), None)
+
 class EnterKeyHandler(sublime_plugin.EventListener):
 	def on_query_context(self, view, key, op, operand, match_all):
 		if key != 'clear_fields_on_enter_key':
 			return None
 
-		if settings.get('clear_fields_on_enter_key', False):
+		if _CLEAR_FIELDS_ON_ENTER:
 			view.run_command('clear_fields')
 
 		return True
@@ -761,8 +892,9 @@ class RenameTag(sublime_plugin.TextCommand):
 		sels = list(view.sel())
 		sel_cleared = False
 		with ctx.js() as c:
+			get_tag_name_ranges = c.locals.pyGetTagNameRanges
 			for s in sels:
-				ranges = c.locals.pyGetTagNameRanges(s.begin())
+				ranges = get_tag_name_ranges(s.begin())
 				if ranges:
 					if not sel_cleared:
 						view.sel().clear()
@@ -788,7 +920,7 @@ class EmmetInsertAttribute(sublime_plugin.TextCommand):
 
 class EmmetResetContext(sublime_plugin.TextCommand):
 	def run(self, edit, **kw):
-		update_settings()
+		update_settings(True)
 
 def plugin_loaded():
 	sublime.set_timeout(init, 200)